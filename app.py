@@ -1,16 +1,22 @@
 import os
-import uuid
+import secrets
 import random
 import datetime
 import io
-import pandas as pd
+import csv
+import time
+import threading
+import zlib
 
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, send_file, abort
+    session, send_file, abort, stream_with_context
 )
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import select, text
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, delete, event, insert, select, text
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 # -------------------- Flask app & DB config --------------------
 app = Flask(__name__)
@@ -24,13 +30,36 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 os.makedirs(DATA_DIR, exist_ok=True)
 DB_PATH = os.path.join(DATA_DIR, "experiment.db")
+STIMULI_CSV = os.path.join(BASE_DIR, "stimuli_list.csv")
 
 app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_PATH}"
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# 多线程 WSGI 下连接会跨线程归还连接池；timeout 为等锁秒数（即 busy_timeout）
+SQLITE_CONNECT_ARGS = {"check_same_thread": False, "timeout": 30}
+# db.engine 只负责写：SQLite 同一时刻只有一个写者，单连接池避免写者之间互相抢锁
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_size": 1,
+    "max_overflow": 0,
+    "pool_pre_ping": False,
+    "connect_args": SQLITE_CONNECT_ARGS,
+}
+app.config["SQLALCHEMY_ECHO"] = False
 
 db = SQLAlchemy()
 db.init_app(app)
 
+# 每个新连接设置一次 SQLite PRAGMA：WAL 模式下读写互不阻塞，减少每次提交的 fsync
+with app.app_context():
+    @event.listens_for(db.engine, "connect")
+    def _set_sqlite_pragma(dbapi_conn, conn_record):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA cache_size=-20000")
+        cur.execute("PRAGMA foreign_keys=ON")
+        cur.close()
+
 # -------------------- 数据模型 --------------------
 class Response(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -53,30 +82,141 @@ class Response(db.Model):
     run_id = db.Column(db.String(36))           # 同一次作答的 ID
     is_complete = db.Column(db.Boolean, default=False)  # 该次作答是否已完整提交
 
-with app.app_context():
-    db.create_all()
+    __table_args__ = (
+        db.Index("ix_response_run_id", "run_id"),
+        db.Index("ix_response_is_complete", "is_complete"),
+    )
 
-    # 软迁移：为旧库补充列
-    from sqlalchemy import inspect, text as sa_text
-    insp = inspect(db.engine)
-    cols = [c["name"] for c in insp.get_columns("response")]
+with app.app_context():
+    # 增量 auto_vacuum：删除后的空闲页由后台任务逐步归还，不在请求里整库 VACUUM；
+    # 旧库需要一次 VACUUM 才能切换模式
+    with db.engine.connect() as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+            conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.exec_driver_sql("VACUUM")
+
+    # 建表 + 软迁移（为旧库补充列）放在同一个事务、同一个连接里完成；
+    # pysqlite 不会为 DDL 自动开事务，需显式 BEGIN（SQLite 的 DDL 支持事务）
     with db.engine.begin() as conn:
+        conn.exec_driver_sql("BEGIN")
+        db.metadata.create_all(conn)
+        cols = {r[1] for r in conn.exec_driver_sql("PRAGMA table_info(response)")}
         if "run_id" not in cols:
-            conn.execute(sa_text("ALTER TABLE response ADD COLUMN run_id VARCHAR(36)"))
+            conn.exec_driver_sql("ALTER TABLE response ADD COLUMN run_id VARCHAR(36)")
         if "is_complete" not in cols:
-            conn.execute(sa_text("ALTER TABLE response ADD COLUMN is_complete BOOLEAN DEFAULT 0"))
+            conn.exec_driver_sql("ALTER TABLE response ADD COLUMN is_complete BOOLEAN DEFAULT 0")
         if "student_id" not in cols:
-            conn.execute(sa_text("ALTER TABLE response ADD COLUMN student_id VARCHAR(20)"))
+            conn.exec_driver_sql("ALTER TABLE response ADD COLUMN student_id VARCHAR(20)")
         if "age" not in cols:
-            conn.execute(sa_text("ALTER TABLE response ADD COLUMN age INTEGER"))
+            conn.exec_driver_sql("ALTER TABLE response ADD COLUMN age INTEGER")
         if "gender" not in cols:
-            conn.execute(sa_text("ALTER TABLE response ADD COLUMN gender VARCHAR(10)"))
+            conn.exec_driver_sql("ALTER TABLE response ADD COLUMN gender VARCHAR(10)")
+        # 旧库补索引：按 run_id 查同一次作答，管理端按 is_complete 统计/导出
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_response_run_id ON response(run_id)")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_response_is_complete ON response(is_complete)")
+
+# -------------------- 后台增量整理 --------------------
+VACUUM_INTERVAL = int(os.getenv("VACUUM_INTERVAL", "600"))  # 秒
+
+def _incremental_vacuum_loop():
+    """定期归还一批空闲页给文件系统。"""
+    with app.app_context():
+        engine = db.engine
+    while True:
+        time.sleep(VACUUM_INTERVAL)
+        try:
+            with engine.connect() as conn:
+                # 需用 executescript 让该 PRAGMA 执行到底，普通 execute 每次只释放一页
+                conn.connection.driver_connection.executescript("PRAGMA incremental_vacuum(1000);")
+        except Exception:
+            app.logger.exception("Incremental vacuum failed")
+
+_vacuum_thread = None
+_vacuum_lock = threading.Lock()
+
+def start_vacuum_worker():
+    """启动后台增量整理线程（同一进程内重复调用无效）。
+
+    导入模块时不会自动启动；`python app.py` 会调用它，其他部署方式（如 gunicorn）
+    请只在一个进程里调用一次，避免多个线程争用唯一的写连接。
+    """
+    global _vacuum_thread
+    with _vacuum_lock:
+        if _vacuum_thread is None:
+            _vacuum_thread = threading.Thread(
+                target=_incremental_vacuum_loop, name="incremental-vacuum", daemon=True
+            )
+            _vacuum_thread.start()
+    return _vacuum_thread
+
+# -------------------- 只读连接池 --------------------
+# 管理端的查询/导出走只读引擎；配合 WAL，读者不会阻塞实验提交
+read_engine = create_engine(
+    f"sqlite:///file:{DB_PATH}?mode=ro&cache=private&uri=true",
+    pool_size=10,
+    pool_pre_ping=False,
+    connect_args=SQLITE_CONNECT_ARGS,
+)
+
+@event.listens_for(read_engine, "connect")
+def _set_sqlite_read_pragma(dbapi_conn, conn_record):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-20000")
+    cur.close()
+
+read_session = scoped_session(sessionmaker(bind=read_engine))
+
+@app.teardown_appcontext
+def _remove_read_session(exc):
+    read_session.remove()
+
+# -------------------- 刺激列表（启动时加载一次） --------------------
+def _load_stimuli():
+    """读取 stimuli_list.csv，按版本分组为 (urls, labels, persons) 三个并行元组（只在启动时调用）。"""
+    rows = {"cn": [], "jp": []}
+    with open(STIMULI_CSV, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            version = (row.get("version") or "").strip().lower()
+            if version in rows:
+                rows[version].append(row)
+    stimuli = {}
+    for version, records in rows.items():
+        stimuli[version] = (
+            tuple(r.get("url") or "" for r in records),
+            tuple(
+                r.get("label") or r.get("stimulus_label") or f"item{i+1}"
+                for i, r in enumerate(records)
+            ),
+            tuple(r.get("person") or "" for r in records),
+        )
+    return stimuli
+
+STIMULI = _load_stimuli()
 
 # -------------------- 辅助函数 --------------------
 def admin_required():
     """检查是否已登录管理员。"""
     return bool(session.get("admin"))
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def _format_ns(ns):
+    """把 time.time_ns() 时间戳格式化为入库用的 UTC ISO 字符串；None 或越界返回空串。"""
+    if ns is None:
+        return ""
+    try:
+        return (EPOCH + datetime.timedelta(microseconds=ns // 1000)).isoformat()
+    except (OverflowError, ValueError, TypeError):
+        return ""
+
+@contextmanager
+def immediate_transaction():
+    """开启 BEGIN IMMEDIATE 写事务：一开始就拿写锁，避免由读锁升级时撞上 SQLITE_BUSY。"""
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        yield conn
+
 # -------------------- 首页 --------------------
 @app.route("/")
 def index():
@@ -90,27 +230,20 @@ def start(version):
     if version not in ("cn", "jp"):
         return "Invalid version (use 'cn' or 'jp')", 400
 
-    # 读取并按版本筛选
-    df = pd.read_csv("stimuli_list.csv")
-    sub = df[df["version"].str.lower() == version].copy()
-    if sub.empty:
+    n = len(STIMULI[version][0])
+    if not n:
         return f"No stimuli found for version={version}", 500
 
-    # 转字典 + 打乱 + 固定 index
-    records = sub.to_dict(orient="records")
-    random.shuffle(records)
-    for i, s in enumerate(records):
-        s["stimulus_label"] = s.get("label") or s.get("stimulus_label") or f"item{i+1}"
-        s["person"] = s.get("person", "")
-        s["url"] = s.get("url", "")
-        s["index"] = i  # 模板直接使用
+    # 会话里只存打乱后的下标，刺激内容从内存表中查
+    order = random.sample(range(n), n)
 
     # 会话初始化
-    session["participant_id"] = str(uuid.uuid4())[:8]
+    session["participant_id"] = secrets.token_hex(4)
     session["version"] = version
-    session["stimuli_order"] = records
+    session["stimuli_order"] = order
     session["current_index"] = 0
-    session["run_id"] = str(uuid.uuid4())
+    session["run_id"] = secrets.token_hex(16)
+    session["pending_answers"] = []
 
     return redirect(url_for("participant_info", version=version))
 
@@ -173,30 +306,29 @@ def experiment():
         except Exception:
             form_trial_index = idx
 
-        stim = stimuli_order[idx]
-
-        # 写入一条记录
-        r = Response(
-            participant_id=session.get("participant_id", ""),
-            student_id=session.get("student_id") or "",
-            age=session.get("age"),
-            gender=session.get("gender") or "",
-            version=version,
-            stimulus_label=stim.get("stimulus_label", ""),
-            person=stim.get("person", ""),
-            trial_index=form_trial_index,
-            start_time=request.form.get("start_time", ""),
-            end_time=datetime.datetime.utcnow().isoformat(),
-            q1=int(request.form["q1"]),
-            q2=int(request.form["q2"]),
-            q3=int(request.form["q3"]),
-            q4=int(request.form["q4"]),
-            q5=int(request.form["q5"]),
-            run_id=session.get("run_id"),
-            is_complete=False
-        )
-        db.session.add(r)
-        db.session.commit()
+        # 页面渲染时的时间戳（纳秒整数，由服务端生成，不会晚于当前时间）；异常或越界时留空
+        now_ns = time.time_ns()
+        try:
+            form_start_time = int(request.form.get("start_time", ""))
+        except ValueError:
+            form_start_time = None
+        if form_start_time is not None and not (0 <= form_start_time <= now_ns):
+            form_start_time = None
+
+        # 暂存到会话（刺激只记下标），感谢页一次性批量写入
+        pending = session.get("pending_answers", [])
+        pending.append({
+            "stimulus": stimuli_order[idx],
+            "trial_index": form_trial_index,
+            "start_time": form_start_time,
+            "end_time": now_ns,
+            "q1": int(request.form["q1"]),
+            "q2": int(request.form["q2"]),
+            "q3": int(request.form["q3"]),
+            "q4": int(request.form["q4"]),
+            "q5": int(request.form["q5"]),
+        })
+        session["pending_answers"] = pending
 
         # 进入下一条或结束
         session["current_index"] = idx + 1
@@ -208,14 +340,15 @@ def experiment():
     if idx >= len(stimuli_order):
         return redirect(url_for("thank_you", version=version))
 
-    stim = stimuli_order[idx]
-    start_time = datetime.datetime.utcnow().isoformat()
+    urls, labels, persons = STIMULI[version]
+    j = stimuli_order[idx]
+    start_time = time.time_ns()
 
     tmpl_stim = {
-        "url": stim.get("url", ""),
-        "stimulus_label": stim.get("stimulus_label", ""),
-        "person": stim.get("person", ""),
-        "index": stim.get("index", idx),
+        "url": urls[j],
+        "stimulus_label": labels[j],
+        "person": persons[j],
+        "index": idx,
     }
 
     return render_template(
@@ -233,13 +366,44 @@ def thank_you():
     v = (request.args.get("version") or session.get("version") or "cn").strip().lower()
     version = "cn" if v == "cn" else "jp"
 
-    rid = session.get("run_id")
-    if rid:
+    # 整次作答一次性写入（一个事务、一次 fsync），写入即视为完整提交
+    pending = session.get("pending_answers")
+    if pending:
+        common = {
+            "participant_id": session.get("participant_id", ""),
+            "student_id": session.get("student_id") or "",
+            "age": session.get("age"),
+            "gender": session.get("gender") or "",
+            "version": session.get("version", version),
+            "run_id": session.get("run_id"),
+            "is_complete": True,
+        }
+        _, labels, persons = STIMULI[common["version"]]
         try:
-            db.session.execute(text("UPDATE response SET is_complete = 1 WHERE run_id = :rid"), {"rid": rid})
-            db.session.commit()
+            with immediate_transaction() as conn:
+                conn.execute(insert(Response), [
+                    {
+                        **common,
+                        "stimulus_label": labels[a["stimulus"]],
+                        "person": persons[a["stimulus"]],
+                        "trial_index": a["trial_index"],
+                        "start_time": _format_ns(a["start_time"]),
+                        "end_time": _format_ns(a["end_time"]),
+                        "q1": a["q1"],
+                        "q2": a["q2"],
+                        "q3": a["q3"],
+                        "q4": a["q4"],
+                        "q5": a["q5"],
+                    }
+                    for a in pending
+                ])
+            session["pending_answers"] = []
         except Exception:
-            db.session.rollback()
+            # 作答仍保留在会话中，刷新本页即可重试写入
+            app.logger.exception("Failed to save run %s", common["run_id"])
+            if version == "cn":
+                return "提交保存失败，请稍后刷新本页重试。", 503
+            return "回答の保存に失敗しました。しばらくしてからこのページを再読み込みしてください。", 503
 
     return render_template("thank_you.html", version=version)
 
@@ -264,48 +428,90 @@ def admin_logout():
 def admin_panel():
     if not admin_required():
         return redirect(url_for("admin"))
-    total_completed = db.session.query(Response).filter(Response.is_complete == True).count()
-    total_partial   = db.session.query(Response).filter(
-        (Response.is_complete == False) | (Response.is_complete == None)
-    ).count()
+    # 一次分组聚合同时拿到已完成/未完成数量（NULL 视为未完成）
+    rows = read_session.execute(text(
+        "SELECT COALESCE(is_complete, 0) AS c, COUNT(*) FROM response GROUP BY 1"
+    )).all()
+    counts = {bool(c): n for c, n in rows}
+    total_completed = counts.get(True, 0)
+    total_partial = counts.get(False, 0)
     count = total_completed  # 你原来展示的是答卷总数，可改为已完成数量
     return render_template("admin_panel.html", count=count, partial=total_partial)
 
 # -------------------- 导出 CSV --------------------
+EXPORT_HEADER = [
+    "participant_id", "student_id", "age", "gender", "version",
+    "stimulus_label", "person", "trial_index", "start_time", "end_time",
+    "Q1_清晰", "Q2_喜欢", "Q3_亲切", "Q4_违和", "Q5_冷淡",
+]
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_GZIP_LEVEL = 1  # 低压缩级别：CSV 重复内容多，level 1 已足够且几乎不占 CPU
+
+def _gzip_stream(chunks):
+    """把字节块流式压缩成 gzip 格式（wbits=31 即带 gzip 头尾）。"""
+    z = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = z.compress(chunk)
+        if data:
+            yield data
+    yield z.flush()
+
 @app.route("/admin/export_csv")
 def export_csv():
     if not session.get("admin"):
         return redirect(url_for("admin"))
 
-    stmt = select(Response).where(Response.is_complete == True)
-    rows = db.session.execute(stmt).scalars().all()
-
-    records = []
-    for r in rows:
-        records.append({
-            "participant_id": r.participant_id,
-            "student_id": r.student_id or "",
-            "age": r.age or "",
-            "gender": r.gender or "",
-            "version": r.version,
-            "stimulus_label": r.stimulus_label,
-            "person": r.person,
-            "trial_index": r.trial_index,
-            "start_time": r.start_time,
-            "end_time": r.end_time,
-            "Q1_清晰": r.q1,
-            "Q2_喜欢": r.q2,
-            "Q3_亲切": r.q3,
-            "Q4_违和": r.q4,
-            "Q5_冷淡": r.q5,
-        })
-
-    csv_buffer = io.StringIO()
-    pd.DataFrame(records).to_csv(csv_buffer, index=False, encoding="utf-8-sig")
+    # 只取导出需要的列（不构造 ORM 对象）；yield_per 按批从游标取行，不一次性加载进内存
+    stmt = (
+        select(
+            Response.participant_id,
+            Response.student_id,
+            Response.age,
+            Response.gender,
+            Response.version,
+            Response.stimulus_label,
+            Response.person,
+            Response.trial_index,
+            Response.start_time,
+            Response.end_time,
+            Response.q1,
+            Response.q2,
+            Response.q3,
+            Response.q4,
+            Response.q5,
+        )
+        .where(Response.is_complete == True)
+        .execution_options(yield_per=EXPORT_CHUNK_ROWS)
+    )
 
-    mem = io.BytesIO(csv_buffer.getvalue().encode("utf-8-sig"))
-    mem.seek(0)
-    return send_file(mem, mimetype="text/csv", as_attachment=True, download_name="responses.csv")
+    def generate():
+        # 边查边写：每取到一批行就发给客户端（csv 会把 NULL 写成空字符串）
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(EXPORT_HEADER)
+        yield buf.getvalue().encode("utf-8-sig")  # 仅首块带 BOM，方便 Excel 识别
+
+        for rows in read_session.execute(stmt).partitions():
+            buf.seek(0)
+            buf.truncate()
+            writer.writerows(rows)
+            yield buf.getvalue().encode("utf-8")
+
+    body = generate()
+    headers = {
+        "Content-Disposition": "attachment; filename=responses.csv",
+        "Vary": "Accept-Encoding",
+    }
+    # 客户端支持时以 Content-Encoding: gzip 传输，浏览器自动解压，下载到的仍是 responses.csv
+    if request.accept_encodings.quality("gzip") > 0:
+        body = _gzip_stream(body)
+        headers["Content-Encoding"] = "gzip"
+
+    return app.response_class(
+        stream_with_context(body),
+        mimetype="text/csv",
+        headers=headers,
+    )
 
 
 # -------------------- 导出数据库（下载 .db） --------------------
@@ -329,13 +535,8 @@ def clear_db():
     if request.form.get("really") != "yes":
         abort(400, description="Missing confirmation")
     # 删除所有记录
-    deleted = db.session.query(Response).delete()
-    db.session.commit()
-    # 可选：整理 SQLite 文件
-    try:
-        db.session.execute(text("VACUUM"))
-    except Exception:
-        pass
+    with immediate_transaction() as conn:
+        conn.execute(delete(Response))
     return redirect(url_for("admin_panel"))
 
 # -------------------- 清空未完成记录 --------------------
@@ -344,23 +545,22 @@ def delete_partials():
     if not admin_required():
         return redirect(url_for("admin"))
     try:
-        deleted = db.session.query(Response).filter(
-            (Response.is_complete == False) | (Response.is_complete == None)
-        ).delete(synchronize_session=False)
-        db.session.commit()
-        # 可选：整理数据库
-        try:
-            db.session.execute(text("VACUUM"))
-        except Exception:
-            pass
+        with immediate_transaction() as conn:
+            deleted = conn.execute(delete(Response).where(
+                (Response.is_complete == False) | (Response.is_complete == None)
+            )).rowcount
         from flask import flash
         flash(f"已删除未完成记录 {deleted} 条。")
     except Exception as e:
-        db.session.rollback()
         from flask import flash
         flash(f"删除未完成记录失败：{e}")
     return redirect(url_for("admin_panel"))
 
 # -------------------- 启动 --------------------
 if __name__ == "__main__":
-    app.run(debug=True)
+    # 调试模式需显式开启（FLASK_DEBUG=1），压测/生产不要带 debug
+    debug = os.getenv("FLASK_DEBUG") == "1"
+    # 开启重载器时只在真正处理请求的子进程里启动后台整理
+    if not debug or os.getenv("WERKZEUG_RUN_MAIN") == "true":
+        start_vacuum_worker()
+    app.run(debug=debug)